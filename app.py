@@ -1,14 +1,72 @@
 import streamlit as st
 from google import genai
 from google.genai.errors import APIError
+import httpx
+import numpy as np
 import pandas as pd
-import json
+import orjson
+import msgspec
+import asyncio
+import hashlib
+import math
+import os
+import random
 import re
+import tempfile
+import threading
 import time
-from typing import List, Dict, Any, Optional
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, List, Dict, Any, Literal, Optional
 
 # --- Константы и Настройки ---
 MODEL_NAME = "gemini-2.5-flash"
+# Квота запросов в минуту (RPM) для тарифа и типичная длительность одного запроса.
+# Допустимое число одновременных запросов ~ RPM * длительность / 60 (500 RPM -> 8).
+GEMINI_RPM = 500
+GEMINI_TYPICAL_LATENCY_S = 1.0
+GEMINI_CONCURRENCY = max(1, int(GEMINI_RPM * GEMINI_TYPICAL_LATENCY_S / 60))
+# Квота входных токенов в минуту (TPM); для оценки токенов промпта берется ~4 символа на токен
+GEMINI_TPM = 1_000_000
+# Время жизни кэша ответов Gemini в памяти и на диске (секунды)
+RESPONSE_CACHE_TTL = 24 * 3600
+LLM_DISK_CACHE_TTL = 7 * 24 * 3600
+# Дисковый кэш: предельное число файлов и период очистки от устаревших и лишних файлов (секунды)
+LLM_DISK_CACHE_MAX_FILES = 5000
+LLM_DISK_CACHE_SWEEP_INTERVAL_S = 3600
+# Предельное число записей кэшей в памяти процесса (ответы, разобранный анализ, подсчет токенов)
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+ANALYSIS_CACHE_MAX_ENTRIES = 5000
+TOKEN_COUNT_CACHE_MAX_ENTRIES = 1000
+# Каталог дискового кэша ответов; увеличьте PROMPT_CACHE_VERSION, чтобы сбросить его
+LLM_CACHE_DIR = Path(__file__).parent / ".llm_cache"
+PROMPT_CACHE_VERSION = 1
+# Повторы вызовов Gemini: только временные ошибки (лимиты, перегрузка, сбой сервера),
+# пауза — full jitter с базой RETRY_BASE_DELAY_S и потолком RETRY_MAX_DELAY_S (секунды)
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+# Сетевые сбои транспорта (таймаут GEMINI_TIMEOUT_MS, обрыв соединения) приходят не как APIError
+RETRYABLE_NETWORK_ERRORS = (httpx.TimeoutException, httpx.ConnectError)
+RETRY_BASE_DELAY_S = 1.0
+RETRY_MAX_DELAY_S = 30.0
+# Таймаут одного HTTP-запроса к Gemini (миллисекунды)
+GEMINI_TIMEOUT_MS = 60_000
+# Лимит входных токенов модели. Один символ дает не больше 4 токенов (побайтово в UTF-8),
+# поэтому промпты короче MODEL_INPUT_TOKEN_LIMIT // 4 символов не проверяются через count_tokens
+MODEL_INPUT_TOKEN_LIMIT = 1_048_576
+# Число ответов/запросов на одной странице детальных списков
+PAGE_SIZE = 20
+# Длина превью ответа в списке сырых ответов (Шаг 5, символы)
+ANSWER_PREVIEW_CHARS = 2000
+# Живой просмотр ответов при сборе (Шаг 3): период обновления (с) и длина показываемого хвоста (символы)
+PREVIEW_INTERVAL_S = 0.1
+PREVIEW_CHARS = 1500
+# Лимиты одного пакетного вызова анализа (Шаг 5): символы ответов ограничивают вход
+# (контекст модели), число ответов — объем JSON-вывода (лимит выходных токенов)
+SOV_BATCH_MAX_CHARS = 400_000
+SOV_BATCH_MAX_DOCS = 50
+# Максимальный размер одного фрагмента текста для извлечения брендов (Шаг 4, символы)
+EXTRACTION_CHUNK_CHARS = 8000
 
 # JSON-схема для структурированного позиционного и тонального анализа (Шаг 5)
 # Схема остается, но инструкция LLM будет требовать вернуть ВСЕ упомянутые бренды.
@@ -33,52 +91,524 @@ SOV_ANALYSIS_SCHEMA = {
     }
 }
 
+# --- КОНСТАНТЫ СЧЕТА И МНОЖИТЕЛЕЙ ---
+# Базовый позиционный балл (Position Score)
+# 3-е место и все последующие получают базовый балл 1.0
+POSITION_SCORES = {
+    0: 3.0, # 1st place
+    1: 2.0, # 2nd place
+    2: 1.0, # 3rd place
+}
+# Тональные множители (Sentiment Multipliers)
+SENTIMENT_MULTIPLIERS = {
+    "Positive": 1.5,
+    "Neutral": 1.0,
+    "Negative": 0.0
+}
+# Готовый счет для каждой пары (позиция, тональность); позиции >= 2 сводятся к 2
+SCORE_TABLE = {
+    (rank, sentiment): POSITION_SCORES[rank] * multiplier
+    for rank in POSITION_SCORES
+    for sentiment, multiplier in SENTIMENT_MULTIPLIERS.items()
+}
+# -------------------------------------------
+
+# Системная инструкция для позиционного и тонального анализа (Шаг 5)
+SYSTEM_INSTRUCTION_ANALYSIS = (
+    "Вы — высокоточный движок позиционного и тонального анализа сущностей. "
+    "Внимательно проанализируйте весь предоставленный 'ТЕКСТ_ДЛЯ_АНАЛИЗА' (сырой ответ Gemini). "
+    "Ваша задача — определить, **все** бренды из 'СПИСОК_БРЕНДОВ', которые упоминаются в тексте. "
+    "Верните полный список упомянутых брендов, **ранжированный по их заметности или порядку упоминания** (самый заметный/первый в списке должен быть на позиции 1). "
+    "Для каждого бренда определите тональность упоминания (Positive, Neutral, или Negative). "
+    "Используйте названия брендов СТРОГО из 'СПИСОК_БРЕНДОВ'. Выведите ТОЛЬКО JSON-объект, следуя предоставленной схеме. Не выводите другой текст."
+)
+
+# Пакетная схема: анализ нескольких ответов одним вызовом, результат привязан к индексу ответа
+SOV_BATCH_ANALYSIS_SCHEMA = {
+    "type": "ARRAY",
+    "description": "One entry per document from 'ОТВЕТЫ', identified by its index.",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "index": {
+                "type": "INTEGER",
+                "description": "The 'index' of the analysed document from 'ОТВЕТЫ'."
+            },
+            "brands": SOV_ANALYSIS_SCHEMA
+        },
+        "required": ["index", "brands"],
+        "propertyOrdering": ["index", "brands"]
+    }
+}
+
+def strip_descriptions(schema: Any) -> Any:
+    """Копия схемы без полей 'description' (на любом уровне вложенности)."""
+    if isinstance(schema, dict):
+        return {k: strip_descriptions(v) for k, v in schema.items() if k != "description"}
+    if isinstance(schema, list):
+        return [strip_descriptions(v) for v in schema]
+    return schema
+
+# Схемы выше — документация для разработчика. В API уходят облегченные версии без описаний:
+# их смысл уже изложен в системных инструкциях, а описания лишь увеличивают каждый запрос.
+SOV_ANALYSIS_SCHEMA_SLIM = strip_descriptions(SOV_ANALYSIS_SCHEMA)
+SOV_BATCH_ANALYSIS_SCHEMA_SLIM = strip_descriptions(SOV_BATCH_ANALYSIS_SCHEMA)
+
+# Типизированная схема SDK: словарь валидируется один раз при загрузке, а не в каждом вызове
+SOV_SCHEMA_OBJ = genai.types.Schema.model_validate(SOV_ANALYSIS_SCHEMA_SLIM)
+SOV_BATCH_SCHEMA_OBJ = genai.types.Schema.model_validate(SOV_BATCH_ANALYSIS_SCHEMA_SLIM)
+
+# Единая конфигурация для всех вызовов анализа Шага 5 (собирается и валидируется один раз)
+SOV_CONFIG = genai.types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=SOV_SCHEMA_OBJ,
+    system_instruction=SYSTEM_INSTRUCTION_ANALYSIS
+)
+
+# Системная инструкция для пакетного анализа нескольких ответов одним вызовом (Шаг 5)
+SYSTEM_INSTRUCTION_BATCH_ANALYSIS = (
+    "Вы — высокоточный движок позиционного и тонального анализа сущностей. "
+    "'ОТВЕТЫ' — JSON-массив документов вида {index, text} (сырые ответы Gemini). "
+    "Проанализируйте КАЖДЫЙ документ независимо от остальных. Для каждого документа определите **все** бренды из 'СПИСОК_БРЕНДОВ', которые упоминаются в его тексте, "
+    "**ранжированные по их заметности или порядку упоминания** (самый заметный/первый должен быть на позиции 1), и тональность каждого упоминания (Positive, Neutral, или Negative). "
+    "Верните по одной записи на документ с его 'index' и списком 'brands'. "
+    "Используйте названия брендов СТРОГО из 'СПИСОК_БРЕНДОВ'. Выведите ТОЛЬКО JSON, следуя предоставленной схеме. Не выводите другой текст."
+)
+
+SOV_BATCH_CONFIG = genai.types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=SOV_BATCH_SCHEMA_OBJ,
+    system_instruction=SYSTEM_INSTRUCTION_BATCH_ANALYSIS
+)
+
+class SovEntry(msgspec.Struct, rename="camel"):
+    """Одна запись ответа по SOV_ANALYSIS_SCHEMA (бренд и тональность упоминания)."""
+    brand_name: str
+    sentiment: Literal["Positive", "Neutral", "Negative"]
+
+class SovBatchEntry(msgspec.Struct):
+    """Одна запись ответа по SOV_BATCH_ANALYSIS_SCHEMA (индекс документа и его бренды)."""
+    index: int
+    brands: List[SovEntry]
+
+# Разбор JSON и проверка схемы за один проход
+SOV_ENTRIES_DECODER = msgspec.json.Decoder(List[SovEntry])
+SOV_BATCH_DECODER = msgspec.json.Decoder(List[SovBatchEntry])
+# Списки строк: запросы (Шаг 2) и извлеченные бренды (Шаг 4).
+# Схема передается в API явно, поэтому корректный список приходит с первой попытки.
+STRING_LIST_SCHEMA = {"type": "ARRAY", "items": {"type": "STRING"}}
+STRING_LIST_DECODER = msgspec.json.Decoder(List[str])
+
+# Символы, которые LLM оставляет по краям названий брендов (пробелы, кавычки, markdown-выделение).
+# Снимаются str.strip только с краев, поэтому апостроф внутри названия (McDonald's) сохраняется.
+BRAND_EDGE_CHARS = " \t\r\n\"'*«»“”"
+# Изменяемые окончания русских слов: упоминание бренда ищется по основе слова без них,
+# чтобы склоненная форма ("Яндекс Метрику") тоже находилась
+INFLECTED_ENDING_RE = re.compile(r"[аеёийоуыьэюя]{1,2}$", re.IGNORECASE)
+
+# --- Кэш Ответов Gemini ---
+# Два уровня: словарь в памяти процесса (общий для сессий) и JSON-файлы на диске,
+# переживающие перезапуск приложения. Ключ — sha256 от модели, конфигурации и промпта.
+
+class BoundedCache:
+    """
+    Кэш в памяти процесса с ограничением размера (LRU) и временем жизни записей.
+    При переполнении вытесняется давно не использованная запись, устаревшая запись удаляется при чтении.
+    Общий для всех сессий, поэтому операции защищены threading.Lock.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict() # ключ -> (момент устаревания или None, значение)
+        self.lock = threading.Lock()
+
+    def get(self, key: Any) -> Any:
+        """Значение по ключу или None, если записи нет или она устарела."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and time.time() >= entry[0]:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Any, value: Any, expires_at: Optional[float] = None) -> None:
+        """Сохраняет значение; `expires_at` сокращает срок жизни записи (не продлевает его сверх ttl)."""
+        if self.ttl is not None:
+            ttl_expiry = time.time() + self.ttl
+            expires_at = ttl_expiry if expires_at is None else min(expires_at, ttl_expiry)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> BoundedCache:
+    """
+    Общий для всех сессий и reruns кэш ответов: ключ запроса -> текст ответа.
+    Используется и синхронным, и асинхронным вызовом, поэтому это объект процесса, а не st.cache_data.
+    """
+    return BoundedCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+
+def response_cache_key(prompt: str, config: genai.types.GenerateContentConfig) -> str:
+    """
+    Ключ кэша. Конфигурация (инструкция, схема) сериализуется целиком, чтобы ее изменение
+    инвалидировало записи; PROMPT_CACHE_VERSION позволяет сбросить кэш вручную.
+    """
+    return hashlib.sha256(b"\x00".join([
+        MODEL_NAME.encode(),
+        str(PROMPT_CACHE_VERSION).encode(),
+        config.model_dump_json(exclude_none=True).encode(),
+        prompt.encode()
+    ])).hexdigest()
+
+def get_cached_response(key: str) -> str | None:
+    text = get_response_cache().get(key)
+    if text is not None:
+        return text
+
+    # Промах в памяти: пробуем дисковый кэш
+    path = LLM_CACHE_DIR / f"{key}.json"
+    try:
+        record = orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    expires_at = record.get("created_at", 0) + LLM_DISK_CACHE_TTL
+    if time.time() >= expires_at:
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+        return None
+    # В памяти запись живет не дольше, чем на диске: срок отсчитывается от исходного created_at
+    get_response_cache().put(key, record["response"], expires_at=expires_at)
+    return record["response"]
+
+@st.cache_resource(show_spinner=False)
+def get_disk_sweep_state() -> Dict[str, float]:
+    """Время последней очистки дискового кэша (общее для сессий)."""
+    return {'swept_at': 0.0}
+
+def sweep_disk_cache() -> None:
+    """
+    Удаляет из LLM_CACHE_DIR файлы старше LLM_DISK_CACHE_TTL (включая брошенные временные)
+    и самые старые записи сверх LLM_DISK_CACHE_MAX_FILES. Выполняется не чаще раза в LLM_DISK_CACHE_SWEEP_INTERVAL_S.
+    """
+    state = get_disk_sweep_state()
+    now = time.time()
+    if now - state['swept_at'] < LLM_DISK_CACHE_SWEEP_INTERVAL_S:
+        return
+    state['swept_at'] = now
+
+    records = []
+    for path in LLM_CACHE_DIR.iterdir():
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            continue # Файл уже удален другой сессией
+        if now - mtime >= LLM_DISK_CACHE_TTL:
+            path.unlink(missing_ok=True)
+        elif path.suffix == ".json":
+            records.append((mtime, path))
+    records.sort()
+    for _, path in records[:max(0, len(records) - LLM_DISK_CACHE_MAX_FILES)]:
+        path.unlink(missing_ok=True)
+
+def put_cached_response(key: str, text: str) -> None:
+    now = time.time()
+    get_response_cache().put(key, text)
+
+    record = {"response": text, "created_at": now, "model": MODEL_NAME, "prompt_version": PROMPT_CACHE_VERSION}
+    try:
+        LLM_CACHE_DIR.mkdir(exist_ok=True)
+        # Запись через временный файл, чтобы параллельный читатель не увидел половину JSON.
+        # Сессии — потоки одного процесса, поэтому имя временного файла уникально для каждой записи (mkstemp)
+        fd, tmp_path = tempfile.mkstemp(dir=LLM_CACHE_DIR, prefix=f"{key}.", suffix=".tmp")
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(orjson.dumps(record))
+        os.replace(tmp_path, LLM_CACHE_DIR / f"{key}.json")
+        sweep_disk_cache()
+    except OSError:
+        pass # Диск недоступен для записи: работаем только с кэшем в памяти
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_cache() -> BoundedCache:
+    """
+    Кэш разобранных результатов анализа Шага 5:
+    (хэш ответа, кортеж брендов) -> (строка отчета, баллы по брендам).
+    """
+    return BoundedCache(ANALYSIS_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+
+def get_cached_analysis(key: tuple) -> Any:
+    return get_analysis_cache().get(key)
+
+def put_cached_analysis(key: tuple, result: Any) -> None:
+    get_analysis_cache().put(key, result)
+
+@st.cache_resource(show_spinner=False)
+def get_token_count_cache() -> BoundedCache:
+    """Кэш подсчета токенов: sha256 промпта -> число токенов (MODEL_NAME). Число не устаревает."""
+    return BoundedCache(TOKEN_COUNT_CACHE_MAX_ENTRIES)
+
+async def count_prompt_tokens(client: genai.Client, prompt: str) -> int:
+    """Число токенов промпта по данным count_tokens; повторный подсчет того же промпта берется из кэша."""
+    key = hashlib.sha256(prompt.encode()).hexdigest()
+    tokens = get_token_count_cache().get(key)
+    if tokens is None:
+        result = await client.aio.models.count_tokens(model=MODEL_NAME, contents=prompt)
+        tokens = result.total_tokens or 0
+        get_token_count_cache().put(key, tokens)
+    return tokens
+
 # --- Функции Взаимодействия с API (с Обработкой Ошибок и Повторами) ---
 
+class TokenBucket:
+    """
+    Ограничитель скорости «ведро токенов», общий для всех сессий и потоков.
+    Каждая сессия Streamlit запускает свой цикл asyncio в своем потоке, поэтому состояние
+    защищено threading.Lock, а ожидание выполняется через asyncio.sleep в цикле вызывающего.
+    """
+
+    def __init__(self, per_minute: float, capacity: float):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost: float = 1.0) -> float:
+        """Списывает `cost` (в долг, если ведро пустое) и возвращает, сколько секунд ждать."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self, cost: float = 1.0) -> None:
+        delay = self.reserve(cost)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiters() -> tuple[TokenBucket, TokenBucket]:
+    """
+    Ограничители запросов (RPM) и входных токенов (TPM) на процесс: параллельные вызовы
+    всех сессий идут вровень с квотой, а не упираются в 429 и каскад повторов.
+    Ведро TPM вмещает квоту целой минуты: крупный пакет не ждет, пока квота далеко не выбрана.
+    """
+    return (
+        TokenBucket(GEMINI_RPM, capacity=GEMINI_CONCURRENCY),
+        TokenBucket(GEMINI_TPM, capacity=GEMINI_TPM)
+    )
+
+def build_generation_config(
+    system_instruction: Optional[str] = None,
+    json_output: bool = False,
+    response_schema: Optional[Dict[str, Any]] = None
+) -> genai.types.GenerateContentConfig:
+    """
+    Собирает конфигурацию генерации. Вызывается один раз до цикла повторов,
+    а не на каждой попытке.
+    """
+    config_params = {}
+    if json_output:
+        config_params["response_mime_type"] = "application/json"
+        # Используем сложную схему, если она предоставлена
+        config_params["response_schema"] = response_schema if response_schema else STRING_LIST_SCHEMA
+
+    if system_instruction:
+        config_params["system_instruction"] = system_instruction
+
+    return genai.types.GenerateContentConfig(**config_params)
+
+def create_gemini_client() -> genai.Client:
+    """Клиент Gemini с ключом из st.secrets и таймаутом HTTP-запроса."""
+    return genai.Client(
+        api_key=st.secrets["GEMINI_API_KEY"],
+        http_options=genai.types.HttpOptions(timeout=GEMINI_TIMEOUT_MS)
+    )
+
+def run_with_client(main: Callable[[genai.Client], Awaitable[Any]]) -> Any:
+    """
+    Выполняет `main(client)` в новом цикле asyncio со своим клиентом Gemini и закрывает клиент по завершении.
+    Асинхронные соединения httpx привязаны к циклу, в котором открыты, поэтому один клиент нельзя
+    переиспользовать между вызовами asyncio.run ("Event loop is closed") или делить между сессиями,
+    у каждой из которых свой цикл. Внутри одного запуска все параллельные вызовы делят пул соединений.
+    Если клиент не создается (например, ключ отклонен), ошибка показывается и выполнение скрипта останавливается.
+    """
+    async def runner():
+        try:
+            client = create_gemini_client()
+        except Exception as e:
+            st.error(f"Ошибка инициализации клиента: {e}. Проверьте ключ API.")
+            st.stop()
+        try:
+            return await main(client)
+        finally:
+            await client.aio.aclose()
+            client.close()
+    return asyncio.run(runner())
+
+def retry_delay(attempt: int) -> float:
+    """
+    Пауза перед повторной попыткой (full jitter): случайное значение от 0 до экспоненциального
+    предела RETRY_BASE_DELAY_S * 2^attempt, но не больше RETRY_MAX_DELAY_S. Параллельные запросы,
+    упершиеся в одну квоту, повторяются вразброс, а не одной волной.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** attempt))
+
 def generate_content_with_retry(
+    prompt: str,
+    system_instruction: Optional[str] = None,
+    max_retries: int = 3,
+    json_output: bool = False,
+    response_schema: Optional[Dict[str, Any]] = None,
+    config: Optional[genai.types.GenerateContentConfig] = None,
+    decoder: Optional[msgspec.json.Decoder] = None
+) -> Any:
+    """
+    Синхронная обертка над generate_content_with_retry_async для одиночных вызовов
+    (Шаг 2): та же конфигурация, кэш, проверка типа и повторы, паузы между попытками через asyncio.sleep.
+    Готовый `config` (например, SOV_CONFIG) заменяет system_instruction/json_output/response_schema.
+    """
+    return run_with_client(lambda client: generate_content_with_retry_async(
+        client,
+        prompt,
+        system_instruction=system_instruction,
+        max_retries=max_retries,
+        json_output=json_output,
+        response_schema=response_schema,
+        config=config,
+        decoder=decoder
+    ))
+
+async def generate_content_with_retry_async(
     client: genai.Client,
     prompt: str,
     system_instruction: Optional[str] = None,
     max_retries: int = 3,
     json_output: bool = False,
-    response_schema: Optional[Dict[str, Any]] = None
-) -> str | None:
+    response_schema: Optional[Dict[str, Any]] = None,
+    config: Optional[genai.types.GenerateContentConfig] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    decoder: Optional[msgspec.json.Decoder] = None,
+    on_attempt: Optional[Callable[[int], None]] = None
+) -> Any:
     """
-    Выполняет вызов Gemini API с обработкой исключений и экспоненциальной задержкой, 
-    с поддержкой структурированного JSON-вывода.
+    Вызов Gemini на базе client.aio с кэшем и повторами; ожидание не блокирует другие запросы.
+    Текстовые ответы (не JSON), а также любые вызовы с `on_chunk` читаются потоком;
+    каждый фрагмент передается в `on_chunk`. `on_attempt` вызывается в начале каждой попытки
+    с ее номером: повтор читает поток заново, и накопленное по фрагментам нужно сбросить.
+    С `decoder` ответ проверяется по типу и возвращается разобранным объектом. Если ответ не прошел
+    проверку, ошибка отправляется модели вместе с ее ответом, и попытка повторяется (retry-with-feedback).
+    Без `decoder` возвращается текст ответа.
     """
-    for attempt in range(max_retries):
+    if not prompt or not prompt.strip():
+        st.warning("Пустой промпт: запрос к Gemini не отправлен.")
+        return None
+
+    if config is None:
+        config = build_generation_config(system_instruction, json_output, response_schema)
+    json_output = config.response_mime_type == "application/json"
+
+    cache_key = response_cache_key(prompt, config)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        if decoder is None:
+            return cached
         try:
-            # Настройка конфигурации генерации
-            config_params = {}
-            if json_output:
-                config_params["response_mime_type"] = "application/json"
-                # Используем сложную схему, если она предоставлена
-                config_params["response_schema"] = response_schema if response_schema else {"type": "ARRAY", "items": {"type": "STRING"}}
-            
-            if system_instruction:
-                config_params["system_instruction"] = system_instruction
-
-            # Вызов API
-            response = client.models.generate_content(
-                model=MODEL_NAME,
-                contents=prompt,
-                config=genai.types.GenerateContentConfig(**config_params)
-            )
+            return decoder.decode(cached)
+        except msgspec.DecodeError:
+            pass # Запись не проходит проверку типа: запрашиваем заново
 
-            # Извлечение текста
-            if response.candidates and response.candidates[0].content:
-                return response.candidates[0].content.parts[0].text
-            
-            st.warning(f"Gemini вернул пустой ответ на попытке {attempt + 1}.")
+    # Слишком длинный промпт отклоняется до отправки, а не после ошибки сервера и всех повторов
+    if len(prompt) > MODEL_INPUT_TOKEN_LIMIT // 4:
+        try:
+            prompt_tokens = await count_prompt_tokens(client, prompt)
+        except APIError:
+            prompt_tokens = 0 # Подсчет недоступен: решение остается за сервером
+        if prompt_tokens > MODEL_INPUT_TOKEN_LIMIT:
+            st.error(f"Промпт слишком длинный ({prompt_tokens} токенов при лимите {MODEL_INPUT_TOKEN_LIMIT}). Запрос не отправлен.")
             return None
 
-        except APIError as e:
-            st.error(f"Ошибка API (Попытка {attempt + 1}/{max_retries}): {e}")
+    rpm_limiter, tpm_limiter = get_rate_limiters()
+    contents: Any = prompt
+    for attempt in range(max_retries):
+        if on_attempt:
+            on_attempt(attempt)
+        try:
+            # Каждая попытка (включая повторы) проходит через общие лимиты RPM и TPM
+            await rpm_limiter.acquire()
+            await tpm_limiter.acquire(len(prompt) / 4)
+            text = None
+            if not json_output or on_chunk is not None:
+                # Потоковое чтение: передача по сети идет параллельно с накоплением текста
+                stream = await client.aio.models.generate_content_stream(
+                    model=MODEL_NAME,
+                    contents=contents,
+                    config=config
+                )
+                pieces: List[str] = []
+                async for chunk in stream:
+                    if chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts:
+                        piece = chunk.candidates[0].content.parts[0].text
+                        if piece:
+                            pieces.append(piece)
+                            if on_chunk:
+                                on_chunk(piece)
+                if pieces:
+                    text = "".join(pieces)
+            else:
+                response = await client.aio.models.generate_content(
+                    model=MODEL_NAME,
+                    contents=contents,
+                    config=config
+                )
+                if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
+                    text = response.candidates[0].content.parts[0].text
+
+            if not text:
+                st.warning(f"Gemini вернул пустой ответ на попытке {attempt + 1}.")
+                return None
+
+            if decoder is None:
+                put_cached_response(cache_key, text)
+                return text
+
+            try:
+                parsed = decoder.decode(text)
+            except msgspec.DecodeError as e:
+                st.warning(f"Ответ не прошел проверку схемы (Попытка {attempt + 1}/{max_retries}): {e}")
+                # Следующая попытка видит свой неверный ответ и текст ошибки
+                contents = [
+                    genai.types.Content(role="user", parts=[genai.types.Part(text=prompt)]),
+                    genai.types.Content(role="model", parts=[genai.types.Part(text=text)]),
+                    genai.types.Content(role="user", parts=[genai.types.Part(
+                        text=f"В вашем ответе ошибка: {e}. Исправьте ее и выведите ответ заново, строго по схеме."
+                    )])
+                ]
+                continue
+            # В кэш попадают только ответы, прошедшие проверку
+            put_cached_response(cache_key, text)
+            return parsed
+
+        except (APIError, *RETRYABLE_NETWORK_ERRORS) as e:
+            if isinstance(e, APIError):
+                st.error(f"Ошибка API (Попытка {attempt + 1}/{max_retries}): {e}")
+                if e.code not in RETRYABLE_STATUS_CODES:
+                    # Ошибка запроса (400 схема, 401/403 ключ, 404 модель): повтор даст тот же результат
+                    return None
+            else:
+                st.error(f"Сетевая ошибка (Попытка {attempt + 1}/{max_retries}): {type(e).__name__}: {e}")
             if attempt < max_retries - 1:
-                wait_time = 2 ** attempt
-                st.warning(f"Ожидание {wait_time} секунд перед повторной попыткой...")
-                time.sleep(wait_time)
+                wait_time = retry_delay(attempt)
+                st.warning(f"Ожидание {wait_time:.1f} секунд перед повторной попыткой...")
+                await asyncio.sleep(wait_time)
             else:
                 return None
         except Exception as e:
@@ -86,28 +616,137 @@ def generate_content_with_retry(
             return None
     return None
 
+async def gather_bounded(coros: List[Any], on_done=None, limit: int = GEMINI_CONCURRENCY) -> List[Any]:
+    """
+    Запускает корутины параллельно (не более `limit` одновременно) и возвращает
+    результаты в исходном порядке. `on_done(completed)` вызывается после каждой завершенной задачи.
+    """
+    semaphore = asyncio.Semaphore(limit)
+    completed = 0
+
+    async def run(coro):
+        nonlocal completed
+        async with semaphore:
+            result = await coro
+        completed += 1
+        if on_done:
+            on_done(completed)
+        return result
+
+    return await asyncio.gather(*(run(c) for c in coros), return_exceptions=True)
+
+# --- Разбор Пользовательского Ввода ---
+
+@st.cache_data(show_spinner=False)
+def parse_lines(text: str) -> tuple[str, ...]:
+    """
+    Список непустых строк (по одной на строку) без повторов, в исходном порядке;
+    кэшируется по исходному тексту между reruns.
+    """
+    return tuple(dict.fromkeys(x.strip() for x in text.split('\n') if x.strip()))
+
+@st.cache_data(show_spinner=False)
+def parse_csv(text: str) -> tuple[str, ...]:
+    """
+    Список непустых значений через запятую без повторов, в исходном порядке;
+    кэшируется по исходному тексту между reruns.
+    """
+    return tuple(dict.fromkeys(x.strip() for x in text.split(',') if x.strip()))
+
+def brand_mention_pattern(brand: str) -> str:
+    """
+    Регулярное выражение упоминания бренда с любым окончанием: у каждого слова отбрасывается
+    изменяемое окончание (основа не короче 3 символов), после основы допускаются любые буквы,
+    между словами — любые разделители или ничего. "Яндекс Метрика" находит и "Яндекс Метрику",
+    и "Яндекс.Метрика", и "**Яндекс** Метрика"; "Google Analytics" — и "GoogleAnalytics".
+    """
+    parts = []
+    for word in brand.split():
+        stem = INFLECTED_ENDING_RE.sub("", word)
+        if len(stem) < 3:
+            stem = word
+        parts.append(re.escape(stem) + r"\w*")
+    return r"[\W_]*".join(parts)
+
+# --- Хранение Ответов в Сессии ---
+# Сырые ответы Gemini хранятся в session_state сжатыми (zlib) и распаковываются по требованию
+
+def pack_answer(query: str, answer_text: str) -> Dict[str, Any]:
+    return {'query': query, 'answer_z': zlib.compress(answer_text.encode('utf-8'))}
+
+def get_answer(item: Dict[str, Any]) -> str:
+    return zlib.decompress(item['answer_z']).decode('utf-8')
+
+# --- Постраничная Отрисовка Списков ---
+# Фрагменты: смена страницы или выбранного элемента перерисовывает только список, а не весь скрипт
+
+def page_slice(total: int, key: str) -> range:
+    """Выбор страницы (если их больше одной) и диапазон индексов элементов на ней."""
+    pages = max(1, math.ceil(total / PAGE_SIZE))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Страница (из {pages})", min_value=1, max_value=pages, value=1, key=key)
+    return range((page - 1) * PAGE_SIZE, min(page * PAGE_SIZE, total))
+
+@st.fragment
+def render_raw_responses(raw_responses: List[Dict[str, Any]]) -> None:
+    """
+    Ответы отрисовываются только по запросу пользователя: тело свернутого st.expander все равно
+    выполняется и отправляется в браузер, а выключенный переключатель не отрисовывает ничего.
+    Длинный ответ показывается первыми ANSWER_PREVIEW_CHARS символами до нажатия «Показать полностью».
+    """
+    if not st.toggle(f"Показать сырые ответы ({len(raw_responses)})", key="show_raw_responses"):
+        return
+    for i in page_slice(len(raw_responses), key="raw_responses_page"):
+        item = raw_responses[i]
+        with st.expander(f"Ответ {i+1}: {item['query'][:60]}..."):
+            answer_text = get_answer(item)
+            if len(answer_text) > ANSWER_PREVIEW_CHARS and not st.toggle("Показать полностью", key=f"raw_response_full_{i}"):
+                answer_text = answer_text[:ANSWER_PREVIEW_CHARS] + " …"
+            st.code(answer_text, language='markdown')
+
+@st.fragment
+def render_analysis_details(analysis_details: List[Dict[str, Any]]) -> None:
+    """
+    Сводка по всем запросам — в виртуализированной таблице (st.dataframe),
+    полный текст анализа и ответа — только для одного выбранного запроса.
+    """
+    if not analysis_details:
+        return
+    st.dataframe(
+        pd.DataFrame(analysis_details, columns=['Запрос', 'Общий Счет Запроса']),
+        use_container_width=True,
+        hide_index=True
+    )
+    i = st.selectbox(
+        "Запрос для подробного просмотра",
+        range(len(analysis_details)),
+        format_func=lambda i: f"{i+1}. {analysis_details[i]['Запрос'][:60]} (Счет: {analysis_details[i]['Общий Счет Запроса']})",
+        key="analysis_details_choice"
+    )
+    detail = analysis_details[i]
+    st.markdown(f"**Запрос:** `{detail['Запрос']}`")
+    st.markdown(f"**Общий Счет Запроса:** `{detail['Общий Счет Запроса']}`")
+    st.markdown(f"**Детали Анализа:**")
+    st.code(detail['Анализ (Позиция, Тональность, Счет)'], language='markdown')
+    st.markdown("---")
+    st.markdown("**Полный Ответ Gemini:**")
+    st.code(get_answer(detail), language='markdown')
+
 # --- Инициализация Состояния Streamlit ---
+# setdefault задает значение только при первом запуске сессии
 
-if 'step' not in st.session_state:
-    st.session_state.step = 1
+st.session_state.setdefault('step', 1)
 # Инициализация brand и industry, чтобы избежать AttributeError
-if 'brand' not in st.session_state: 
-    st.session_state.brand = ''
-if 'industry' not in st.session_state: 
-    st.session_state.industry = ''
-    
-if 'user_queries' not in st.session_state:
-    st.session_state.user_queries = ""
-if 'tracked_brands' not in st.session_state:
-    st.session_state.tracked_brands = "" # Изменено имя переменной для ясности
-if 'results' not in st.session_state:
-    st.session_state.results = None
-if 'client' not in st.session_state:
-    st.session_state.client = None
-if 'analysis_details' not in st.session_state:
-    st.session_state.analysis_details = [] # Хранение детальных результатов
-if 'raw_responses' not in st.session_state:
-    st.session_state.raw_responses = [] # Хранение сырых ответов Gemini
+st.session_state.setdefault('brand', '')
+st.session_state.setdefault('industry', '')
+
+st.session_state.setdefault('user_queries', "")
+st.session_state.setdefault('tracked_brands', "") # Изменено имя переменной для ясности
+st.session_state.setdefault('results', None)
+st.session_state.setdefault('api_configured', False) # Ключ GEMINI_API_KEY найден в st.secrets
+st.session_state.setdefault('analysis_details', []) # Хранение детальных результатов
+st.session_state.setdefault('raw_responses', []) # Хранение сырых ответов Gemini
 
 # --- UI и Логика Приложения ---
 
@@ -124,44 +763,51 @@ st.markdown("Измерьте, как часто Gemini рекомендует 
 st.header("Шаг 1: Ввод Настроек")
 st.info("Пожалуйста, заполните поля для начала анализа.")
 
-with st.expander("Конфигурация", expanded=True):
+# Поля ввода читаются только по нажатию кнопки, поэтому их редактирование перерисовывает
+# лишь этот фрагмент, а не все шаги ниже. Переход к Шагу 2 — полный st.rerun().
+@st.fragment
+def render_settings() -> None:
+    with st.expander("Конфигурация", expanded=True):
     
-    brand = st.text_input(
-        "Ваш Бренд (YOUR_BRAND_NAME)", 
-        # Используем значение из session_state для сохранения после reruns
-        value=st.session_state.brand if st.session_state.brand else 'AI-SaaS Tracker Pro',
-        help="Название вашего бренда, который вы отслеживаете."
-    )
-    industry = st.text_area(
-        "Описание Индустрии (INDUSTRY_DESCRIPTION)", 
-        # Используем значение из session_state для сохранения после reruns
-        value=st.session_state.industry if st.session_state.industry else 'Инструменты для аналитики AI-решений и отслеживания метрик SaaS.',
-        help="Подробное описание вашей категории продукта/рынка."
-    )
+        brand = st.text_input(
+            "Ваш Бренд (YOUR_BRAND_NAME)", 
+            # Используем значение из session_state для сохранения после reruns
+            value=st.session_state.brand if st.session_state.brand else 'AI-SaaS Tracker Pro',
+            help="Название вашего бренда, который вы отслеживаете."
+        )
+        industry = st.text_area(
+            "Описание Индустрии (INDUSTRY_DESCRIPTION)", 
+            # Используем значение из session_state для сохранения после reruns
+            value=st.session_state.industry if st.session_state.industry else 'Инструменты для аналитики AI-решений и отслеживания метрик SaaS.',
+            help="Подробное описание вашей категории продукта/рынка."
+        )
 
-    if st.button("Сохранить Настройки и Перейти к Шагу 2"):
+        if st.button("Сохранить Настройки и Перейти к Шагу 2"):
         
-        # --- Инициализация клиента ---
-        if "GEMINI_API_KEY" not in st.secrets:
-            st.error("Ошибка: Ключ 'GEMINI_API_KEY' не найден в конфигурации.")
-            pass
-        else:
-            api_key_to_use = st.secrets["GEMINI_API_KEY"]
-            
-            if brand and industry:
+            # --- Проверка ключа API ---
+            # Клиенты для вызовов создаются на каждый запуск (run_with_client) и читают ключ из st.secrets.
+            # Здесь ключ проверяется пробным клиентом один раз за сессию: после успешной проверки
+            # повторное нажатие не читает st.secrets и не создает клиент
+            if not st.session_state.api_configured and "GEMINI_API_KEY" not in st.secrets:
+                st.error("Ошибка: Ключ 'GEMINI_API_KEY' не найден в конфигурации.")
+            elif brand and industry:
                 try:
-                    # Инициализируем клиент
-                    st.session_state.client = genai.Client(api_key=api_key_to_use)
+                    if not st.session_state.api_configured:
+                        create_gemini_client().close()
+                except Exception as e:
+                    st.error(f"Ошибка инициализации клиента: {e}. Проверьте доступность API.")
+                else:
+                    st.session_state.api_configured = True
                     # Обновляем session_state после успешного ввода
                     st.session_state.brand = brand
                     st.session_state.industry = industry
                     st.session_state.step = 2 # Переход к Шагу 2 (Генерация Запросов)
                     st.rerun()
-                except Exception as e:
-                    st.error(f"Ошибка инициализации клиента: {e}. Проверьте доступность API.")
             else:
                 st.error("Пожалуйста, заполните поля 'Бренд' и 'Индустрия'.")
 
+render_settings()
+
 if st.session_state.step >= 2:
     st.divider()
 
@@ -171,7 +817,7 @@ if st.session_state.step >= 2:
     st.markdown("Сгенерируйте **5** типовых запросов на прямую рекомендацию.")
     
     if st.button("Сгенерировать Рекомендательные Запросы", disabled=st.session_state.step != 2):
-        if st.session_state.client:
+        if st.session_state.api_configured:
             with st.spinner("Gemini генерирует запросы..."):
                 prompt = (
                     f"На основе бренда '{st.session_state.brand}' и описания индустрии '{st.session_state.industry}', "
@@ -179,23 +825,18 @@ if st.session_state.step >= 2:
                     f"'лучший [категория]', 'посоветуй [категорию]'). Выведи только JSON-список строк."
                 )
                 
-                json_response = generate_content_with_retry(
-                    st.session_state.client, 
+                # Ответ проверяется как JSON-список строк; неверный ответ повторяется с текстом ошибки
+                queries = generate_content_with_retry(
                     prompt, 
-                    json_output=True
+                    json_output=True,
+                    response_schema=STRING_LIST_SCHEMA,
+                    decoder=STRING_LIST_DECODER
                 )
                 
-                if json_response:
-                    try:
-                        queries = json.loads(json_response)
-                        if isinstance(queries, list) and all(isinstance(q, str) for q in queries):
-                            st.session_state.user_queries = "\n".join(queries)
-                            st.session_state.step = 3 # Переход к Шагу 3 (Сбор Ответов)
-                            st.success("Запросы сгенерированы! Перейдите к Шагу 3.")
-                        else:
-                            st.error("Ошибка парсинга: Gemini не вернул корректный JSON-список строк.")
-                    except json.JSONDecodeError:
-                        st.error(f"Ошибка: Не удалось декодировать JSON. Ответ Gemini: {json_response[:200]}...")
+                if queries:
+                    st.session_state.user_queries = "\n".join(queries)
+                    st.session_state.step = 3 # Переход к Шагу 3 (Сбор Ответов)
+                    st.success("Запросы сгенерированы! Перейдите к Шагу 3.")
                 else:
                     st.error("Не удалось сгенерировать запросы.")
 
@@ -208,7 +849,7 @@ if st.session_state.step >= 2:
             height=150
         )
         st.session_state.user_queries = user_queries_input # Обновляем состояние после редактирования
-        final_queries = [q.strip() for q in st.session_state.user_queries.split('\n') if q.strip()]
+        final_queries = parse_lines(st.session_state.user_queries)
         
         st.caption(f"Будет использовано запросов: {len(final_queries)}")
     
@@ -223,26 +864,67 @@ if st.session_state.step >= 2:
         if st.button("Получить Ответы Gemini", disabled=st.session_state.step != 3):
             if not final_queries:
                 st.error("Убедитесь, что запросы заполнены в Шаге 2.")
-            elif st.session_state.client:
+            elif st.session_state.api_configured:
                 st.session_state.raw_responses = [] # Сброс
                 N = len(final_queries)
                 progress_bar = st.progress(0, text="Идет получение ответов...")
 
-                for i, query in enumerate(final_queries):
-                    progress_value = (i + 1) / N
-                    progress_bar.progress(progress_value, text=f"Получение ответа на запрос {i+1}/{N}")
-                    
-                    answer_text = generate_content_with_retry(
-                        st.session_state.client, 
+                progress_state = {'completed': 0, 'chars': 0}
+                # Живой просмотр: текст ответа, фрагмент которого пришел последним.
+                # Просмотр и прогресс по фрагментам обновляются не чаще PREVIEW_INTERVAL_S
+                live_preview = st.empty()
+                preview_state = {'shown_at': 0.0}
+
+                def redraw_progress():
+                    progress_bar.progress(
+                        progress_state['completed'] / N,
+                        text=f"Получено ответов: {progress_state['completed']}/{N} (символов принято: {progress_state['chars']})"
+                    )
+
+                def update_progress(completed: int):
+                    progress_state['completed'] = completed
+                    redraw_progress()
+
+                async def fetch_one(client: genai.Client, query: str) -> str | None:
+                    received: List[str] = []
+
+                    def on_chunk(piece: str):
+                        # Ответы приходят потоком, поэтому прогресс и просмотр обновляются во время каждого запроса,
+                        # но не на каждый фрагмент: иначе параллельные потоки заваливают фронтенд обновлениями
+                        received.append(piece)
+                        progress_state['chars'] += len(piece)
+                        now = time.monotonic()
+                        if now - preview_state['shown_at'] >= PREVIEW_INTERVAL_S:
+                            preview_state['shown_at'] = now
+                            redraw_progress()
+                            live_preview.markdown(f"**{query}**\n\n{''.join(received)[-PREVIEW_CHARS:]}")
+
+                    def on_attempt(attempt: int):
+                        # Повтор присылает ответ заново: текст прерванной попытки не учитывается дважды
+                        progress_state['chars'] -= sum(map(len, received))
+                        received.clear()
+
+                    return await generate_content_with_retry_async(
+                        client, 
                         prompt=query, 
-                        max_retries=2
+                        max_retries=2,
+                        on_chunk=on_chunk,
+                        on_attempt=on_attempt
                     )
-                    
-                    if answer_text:
-                        st.session_state.raw_responses.append({'query': query, 'answer': answer_text})
+
+                # Все запросы отправляются одновременно: время сбора ~ max(latency), а не сумма
+                answers = run_with_client(lambda client: gather_bounded(
+                    [fetch_one(client, q) for q in final_queries],
+                    on_done=update_progress
+                ))
+
+                for query, answer_text in zip(final_queries, answers):
+                    if isinstance(answer_text, str) and answer_text:
+                        st.session_state.raw_responses.append(pack_answer(query, answer_text))
                     else:
-                        st.session_state.raw_responses.append({'query': query, 'answer': "Ошибка получения ответа API"})
+                        st.session_state.raw_responses.append(pack_answer(query, "Ошибка получения ответа API"))
                     
+                live_preview.empty()
                 progress_bar.progress(1.0, text="Сбор ответов завершен!")
                 st.success(f"Собрано {len(st.session_state.raw_responses)} ответов. Перейдите к Шагу 4 для определения брендов.")
                 st.session_state.step = 4 # Переход к Шагу 4 (Определение Брендов)
@@ -256,12 +938,26 @@ if st.session_state.step >= 4:
     st.info("На основе собранных ответов Gemini автоматически извлеките все упомянутые бренды. **Ваш бренд включен по умолчанию.** Отредактируйте список перед анализом.")
 
     if st.button("Предложить Бренды для Отслеживания (LLM-Извлечение)", disabled=st.session_state.step != 4 or not st.session_state.raw_responses):
-        if st.session_state.client and st.session_state.raw_responses:
+        if st.session_state.api_configured and st.session_state.raw_responses:
             with st.spinner("LLM анализирует ответы и извлекает бренды..."):
                 
-                # Объединяем все ответы в один большой текст для анализа
-                full_response_text = " ".join([item['answer'] for item in st.session_state.raw_responses])
-                
+                # Ответы упаковываются в фрагменты не длиннее EXTRACTION_CHUNK_CHARS (длинный ответ режется),
+                # бренды извлекаются из фрагментов параллельно, результаты объединяются
+                extraction_chunks: List[str] = []
+                current_chunk: List[str] = []
+                current_chars = 0
+                for item in st.session_state.raw_responses:
+                    answer_text = get_answer(item)
+                    for start in range(0, len(answer_text), EXTRACTION_CHUNK_CHARS):
+                        piece = answer_text[start:start + EXTRACTION_CHUNK_CHARS]
+                        if current_chunk and current_chars + len(piece) > EXTRACTION_CHUNK_CHARS:
+                            extraction_chunks.append(" ".join(current_chunk))
+                            current_chunk, current_chars = [], 0
+                        current_chunk.append(piece)
+                        current_chars += len(piece) + 1
+                if current_chunk:
+                    extraction_chunks.append(" ".join(current_chunk))
+
                 # --- ИЗМЕНЕННАЯ СИСТЕМНАЯ ИНСТРУКЦИЯ ДЛЯ ПОВЫШЕНИЯ ТОЧНОСТИ ---
                 system_instruction_extraction = (
                     "Вы — аналитик, специализирующийся на извлечении названий брендов из текстов. "
@@ -271,36 +967,45 @@ if st.session_state.step >= 4:
                     "Выведите только JSON-список строк (названий брендов)."
                 )
                 # -----------------------------------------------------------------
-                
-                extraction_prompt = f"Ответы LLM: '''{full_response_text}'''"
-                
-                json_extraction_response = generate_content_with_retry(
-                    st.session_state.client, 
-                    extraction_prompt, 
-                    system_instruction=system_instruction_extraction, 
-                    json_output=True
+                extraction_config = build_generation_config(
+                    system_instruction_extraction,
+                    json_output=True,
+                    response_schema=STRING_LIST_SCHEMA
                 )
-                
-                # Инициализируем извлеченные бренды с вашим брендом
-                unique_brands_set = {st.session_state.brand.strip()}
-                
-                if json_extraction_response:
-                    try:
-                        extracted_brands = json.loads(json_extraction_response)
-                        if isinstance(extracted_brands, list) and all(isinstance(b, str) for b in extracted_brands):
-                            # Добавляем все извлеченные бренды
-                            for b in extracted_brands:
-                                if b.strip():
-                                    unique_brands_set.add(b.strip())
-                            
-                            st.session_state.tracked_brands = ", ".join(sorted(list(unique_brands_set)))
-                            st.success("Бренды извлечены. Отредактируйте список ниже.")
-                        else:
-                            st.error("Ошибка парсинга: LLM не вернул корректный JSON-список строк. Попробуйте ввести вручную.")
-                            st.session_state.tracked_brands = st.session_state.brand
-                    except json.JSONDecodeError:
-                        st.error(f"Ошибка: Не удалось декодировать JSON. Ответ LLM: {json_extraction_response[:200]}... Попробуйте ввести вручную.")
-                        st.session_state.tracked_brands = st.session_state.brand
+
+                # Каждый ответ проверяется как JSON-список строк (с повтором и текстом ошибки при неудаче)
+                extraction_results = run_with_client(lambda client: gather_bounded([
+                    generate_content_with_retry_async(
+                        client,
+                        f"Ответы LLM: '''{chunk}'''",
+                        config=extraction_config,
+                        decoder=STRING_LIST_DECODER
+                    )
+                    for chunk in extraction_chunks
+                ]))
+
+                # Инициализируем извлеченные бренды с вашим брендом. dict вместо set: без повторов,
+                # но в порядке упоминания (фрагменты идут в порядке ответов), а не по алфавиту
+                unique_brands = {st.session_state.brand.strip(): None}
+                parsed_chunks = 0
+
+                for chunk_no, extracted_brands in enumerate(extraction_results, start=1):
+                    if isinstance(extracted_brands, BaseException):
+                        # Исключение вернул gather_bounded: само оно еще нигде не показано
+                        st.warning(f"Фрагмент {chunk_no}/{len(extraction_results)} не обработан: {extracted_brands}")
+                        continue
+                    if not isinstance(extracted_brands, list):
+                        continue # Фрагмент не обработан: ошибка уже показана
+                    # Добавляем все извлеченные бренды
+                    for b in extracted_brands:
+                        cleaned_brand = b.strip(BRAND_EDGE_CHARS)
+                        if cleaned_brand:
+                            unique_brands.setdefault(cleaned_brand, None)
+                    parsed_chunks += 1
+
+                if parsed_chunks:
+                    st.session_state.tracked_brands = ", ".join(unique_brands)
+                    st.success("Бренды извлечены. Отредактируйте список ниже.")
                 else:
                     st.error("Не удалось извлечь бренды. Попробуйте ввести вручную.")
                     st.session_state.tracked_brands = st.session_state.brand
@@ -316,13 +1021,13 @@ if st.session_state.step >= 4:
         help="Отредактируйте список, чтобы оставить только те бренды, которые вы хотите включить в анализ SoV. Ваш бренд (YOUR_BRAND_NAME) должен быть включен."
     )
     
-    final_competitors = [c.strip() for c in st.session_state.tracked_brands.split(',') if c.strip()]
+    final_competitors = list(parse_csv(st.session_state.tracked_brands))
     
     # Финальная проверка: ваш бренд должен быть в списке
     if st.session_state.brand.strip() not in final_competitors:
         st.warning(f"Ваш бренд '{st.session_state.brand}' не найден в списке. Он будет добавлен.")
         final_competitors.append(st.session_state.brand.strip())
-        final_competitors = list(set(final_competitors))
+        final_competitors = list(dict.fromkeys(final_competitors))
 
     st.caption(f"Будет отслеживаться брендов: {len(final_competitors)}")
 
@@ -336,10 +1041,13 @@ if st.session_state.step >= 4:
 
 if st.session_state.step >= 5:
     # Убедимся, что final_competitors определен, если мы перешли сюда
-    final_competitors = [c.strip() for c in st.session_state.tracked_brands.split(',') if c.strip()]
+    final_competitors = list(parse_csv(st.session_state.tracked_brands))
     if st.session_state.brand.strip() not in final_competitors:
         final_competitors.append(st.session_state.brand.strip())
-        final_competitors = list(set(final_competitors))
+        final_competitors = list(dict.fromkeys(final_competitors))
+    # Множество для O(1)-проверки принадлежности и словарь для сопоставления без учета регистра
+    competitor_set = set(final_competitors)
+    competitor_lookup = {c.casefold(): c for c in final_competitors}
         
     st.divider()
     
@@ -352,128 +1060,119 @@ if st.session_state.step >= 5:
     if st.session_state.raw_responses:
         st.subheader("Данные для Анализа (Сырые Ответы из Шага 3)")
         st.caption("Проверьте эти ответы. Анализ LLM будет проведен на основе этого текста.")
-        for i, item in enumerate(st.session_state.raw_responses):
-            with st.expander(f"Ответ {i+1}: {item['query'][:60]}..."):
-                st.code(item['answer'], language='markdown')
+        render_raw_responses(st.session_state.raw_responses)
 
 
     if st.button("Провести Структурированный Анализ и Расчет SoV", disabled=st.session_state.step != 5 or not st.session_state.raw_responses):
         if not final_competitors:
             st.error("Убедитесь, что конкуренты заполнены в Шаге 4.")
-        elif st.session_state.client and st.session_state.raw_responses:
-            
-            # --- КОНСТАНТЫ СЧЕТА И МНОЖИТЕЛЕЙ ---
-            # Базовый позиционный балл (Position Score)
-            # 3-е место и все последующие получают базовый балл 1.0 (Fixed: use .get(rank, 1.0))
-            POSITION_SCORES = {
-                0: 3.0, # 1st place
-                1: 2.0, # 2nd place
-                2: 1.0, # 3rd place 
-            }
-            # Тональные множители (Sentiment Multipliers)
-            SENTIMENT_MULTIPLIERS = {
-                "Positive": 1.5,
-                "Neutral": 1.0,
-                "Negative": 0.0
-            }
-            # -------------------------------------------
-            
-            # Инициализация счетчиков
-            brand_scores: Dict[str, float] = {brand.strip(): 0.0 for brand in final_competitors}
-            total_tracked_score = 0.0 # Общий взвешенный счет всех упоминаний
+        elif st.session_state.api_configured and st.session_state.raw_responses:
             
+            # Инициализация счетчиков: позиция бренда в массиве счетов
+            brand_idx = {b: i for i, b in enumerate(final_competitors)}
+            score_idx: List[int] = []
+            score_vals: List[float] = []
+
             st.session_state.analysis_details = [] # Сброс и инициализация детального отчета
-            
-            N = len(st.session_state.raw_responses)
-            TotalSteps = N 
+
+            # Одинаковые ответы анализируются один раз: хэш ответа -> индексы в raw_responses
+            by_hash: Dict[bytes, List[int]] = {}
+            for idx, item in enumerate(st.session_state.raw_responses):
+                # zlib детерминирован, поэтому одинаковые ответы дают одинаковые сжатые байты
+                answer_hash = hashlib.blake2b(item['answer_z'], digest_size=16).digest()
+                by_hash.setdefault(answer_hash, []).append(idx)
+
+            # Ответы, уже проанализированные с тем же списком брендов, берутся из кэша без вызова API
+            competitors_key = tuple(final_competitors)
+            unique_results: Dict[bytes, Any] = {}
+            for answer_hash in by_hash:
+                cached_analysis = get_cached_analysis((answer_hash, competitors_key))
+                if cached_analysis is not None:
+                    unique_results[answer_hash] = cached_analysis
+            pending_hashes = [h for h in by_hash if h not in unique_results]
+
             progress_bar = st.progress(0, text="Идет структурированный анализ...")
+            # Общий счетчик разобранных ответов для всех параллельных пакетов
+            analysis_progress = {'done': 0, 'total': max(1, len(pending_hashes))}
 
-            for i, item in enumerate(st.session_state.raw_responses):
-                query = item['query']
-                answer_text = item['answer']
-                
-                # Пропускаем ответы с ошибками
-                if answer_text == "Ошибка получения ответа API":
-                    st.session_state.analysis_details.append({
-                        'Запрос': query,
-                        'Ответ Gemini': answer_text,
-                        'Анализ (Позиция, Тональность, Счет)': "Ошибка",
-                        'Общий Счет Запроса': 0.0
-                    })
-                    continue
-
-                # Обновление прогресса
-                progress_value = (i + 1) / TotalSteps
-                progress_bar.progress(progress_value, text=f"Анализ упоминаний для запроса {i+1}/{N}")
-
-                # 1. Структурированный анализ упоминаний брендов (LLM-анализ)
-                system_instruction_analysis = (
-                    "Вы — высокоточный движок позиционного и тонального анализа сущностей. "
-                    "Внимательно проанализируйте весь предоставленный 'ТЕКСТ_ДЛЯ_АНАЛИЗА' (сырой ответ Gemini). "
-                    "Ваша задача — определить, **все** бренды из 'СПИСОК_БРЕНДОВ', которые упоминаются в тексте. "
-                    "Верните полный список упомянутых брендов, **ранжированный по их заметности или порядку упоминания** (самый заметный/первый в списке должен быть на позиции 1). "
-                    "Для каждого бренда определите тональность упоминания (Positive, Neutral, или Negative). "
-                    "Используйте названия брендов СТРОГО из 'СПИСОК_БРЕНДОВ'. Выведите ТОЛЬКО JSON-объект, следуя предоставленной схеме. Не выводите другой текст."
-                )
-                
-                analysis_prompt = (
-                    f"ТЕКСТ_ДЛЯ_АНАЛИЗА: '''{answer_text}'''\n\n"
-                    f"СПИСОК_БРЕНДОВ: {final_competitors}"
-                )
-                
-                json_analysis_response = generate_content_with_retry(
-                    st.session_state.client,
-                    analysis_prompt,
-                    system_instruction=system_instruction_analysis,
-                    json_output=True,
-                    response_schema=SOV_ANALYSIS_SCHEMA 
-                )
-                
+            # Общее для всех запросов начало промпта собирается один раз за запуск анализа.
+            # Список брендов идет перед текстом ответов: вместе с системной инструкцией и схемой
+            # он образует одинаковый префикс всех вызовов, который Gemini кэширует неявно (implicit caching).
+            competitor_prefix = "СПИСОК_БРЕНДОВ: " + orjson.dumps(final_competitors).decode() + "\n\n"
+
+            # Предварительный фильтр: ответ без единого упоминания брендов из списка не отправляется в LLM.
+            # Граница слова (через \w, чтобы работать и для "C++"-подобных имен) проверяется только слева:
+            # склоненная форма названия тоже считается упоминанием. Лишнее совпадение стоит только токенов,
+            # а пропущенное обнулило бы счет ответа.
+            brand_re = re.compile(
+                r"(?<!\w)(?:" + "|".join(map(brand_mention_pattern, final_competitors)) + ")",
+                re.IGNORECASE
+            )
+
+            # Для сокращения ответов — поиск подстроки без границ слов: строка с любым вхождением основы
+            # названия (в том числе внутри склоненной или составной формы) остается в тексте для анализа
+            mention_re = re.compile("|".join(map(brand_mention_pattern, final_competitors)), re.IGNORECASE)
+
+            def condense_answer(answer_text: str) -> str:
+                """
+                Сокращает ответ для анализа: остаются строки с упоминаниями брендов и по одной соседней
+                строке контекста (для тональности). Порядок строк сохраняется, поэтому ранжирование
+                по порядку упоминания не меняется.
+                """
+                lines = answer_text.split('\n')
+                keep = set()
+                for i, line in enumerate(lines):
+                    if mention_re.search(line):
+                        keep.update((i - 1, i, i + 1))
+                condensed = '\n'.join(line for i, line in enumerate(lines) if i in keep)
+                return condensed or answer_text
+
+            # Строки отчета не содержат текста ответа: он подставляется ссылкой на сжатые байты
+            # из raw_responses при свертке, поэтому ответ хранится в сессии и в кэше анализа один раз
+            def error_result(query: str) -> tuple[Dict[str, Any], List[tuple[str, float]]]:
+                return {
+                    'Запрос': query,
+                    'Анализ (Позиция, Тональность, Счет)': "Ошибка",
+                    'Общий Счет Запроса': 0.0
+                }, []
+
+            def score_entries(
+                query: str,
+                ranked_entries: List[SovEntry]
+            ) -> tuple[Dict[str, Any], List[tuple[str, float]]]:
+                """
+                Начисляет баллы по ранжированному списку брендов одного ответа и возвращает
+                строку детального отчета и список баллов [(бренд, счет)]. Общие счетчики не изменяются.
+                """
                 current_query_score = 0.0
+                brand_deltas: List[tuple[str, float]] = []
                 detected_brands_details = [] # [{'brandName': 'X', 'sentiment': 'Y', 'score': Z}]
-                
-                if json_analysis_response:
-                    try:
-                        ranked_brands_data = json.loads(json_analysis_response)
-                        
-                        if isinstance(ranked_brands_data, list):
-                            for rank, brand_entry in enumerate(ranked_brands_data):
-                                
-                                brand_name_ranked = brand_entry.get('brandName', '').strip()
-                                sentiment = brand_entry.get('sentiment', 'Neutral').strip()
-                                
-                                # 1. Определяем базовый позиционный балл
-                                # Если ранг >= 2 (3-е место или ниже), используем 1.0. 
-                                # Иначе - 3.0 (rank 0) или 2.0 (rank 1).
-                                base_score = POSITION_SCORES.get(rank, 1.0) 
-                                
-                                # 2. Определяем тональный множитель
-                                multiplier = SENTIMENT_MULTIPLIERS.get(sentiment, 1.0)
-                                
-                                # 3. Расчет итогового счета
-                                final_score = base_score * multiplier
-
-                                # 4. Проверка и сохранение
-                                if brand_name_ranked in final_competitors and final_score > 0:
-                                    
-                                    brand_scores[brand_name_ranked] += final_score
-                                    current_query_score += final_score
-                                    
-                                    detected_brands_details.append({
-                                        'brandName': brand_name_ranked,
-                                        'sentiment': sentiment,
-                                        'score': round(final_score, 2),
-                                        'rank': rank # Сохраняем ранг для отображения
-                                    })
-                                    
-                            # Обновляем общий счет, если был засчитан хотя бы один бренд
-                            if current_query_score > 0:
-                                total_tracked_score += current_query_score
-
-                    except json.JSONDecodeError:
-                        st.error(f"Ошибка декодирования JSON при анализе для запроса: {query}")
-                    
-                
+
+                for rank, entry in enumerate(ranked_entries):
+
+                    brand_name_ranked = entry.brand_name.strip(BRAND_EDGE_CHARS)
+                    if brand_name_ranked not in competitor_set:
+                        # LLM мог изменить регистр: приводим к написанию из финального списка
+                        brand_name_ranked = competitor_lookup.get(brand_name_ranked.casefold(), brand_name_ranked)
+                    sentiment = entry.sentiment
+
+                    # 1. Итоговый счет = позиционный балл x тональный множитель (одна выборка из таблицы)
+                    # Ранг >= 2 (3-е место или ниже) сводится к 2 и получает базовый балл 1.0.
+                    final_score = SCORE_TABLE[(min(rank, 2), sentiment)]
+
+                    # 2. Проверка и сохранение
+                    if brand_name_ranked in competitor_set and final_score > 0:
+
+                        brand_deltas.append((brand_name_ranked, final_score))
+                        current_query_score += final_score
+
+                        detected_brands_details.append({
+                            'brandName': brand_name_ranked,
+                            'sentiment': sentiment,
+                            'score': round(final_score, 2),
+                            'rank': rank # Сохраняем ранг для отображения
+                        })
+
                 # Форматируем детали для отчета
                 details_text = "\n".join([
                     f"  - {d['brandName']}: Позиция {d['rank']+1}, Тональность '{d['sentiment']}', Счет: {d['score']}"
@@ -481,35 +1180,194 @@ if st.session_state.step >= 5:
                 ])
                 if not details_text:
                     details_text = "Не найдено или Счет 0"
-                    
-                # Добавляем детали в отчет
-                st.session_state.analysis_details.append({
+
+                return {
                     'Запрос': query,
-                    'Ответ Gemini': answer_text, 
                     'Анализ (Позиция, Тональность, Счет)': details_text,
                     'Общий Счет Запроса': round(current_query_score, 2)
-                })
-                
+                }, brand_deltas
+
+            async def analyze_one(client: genai.Client, answer_hash: bytes) -> tuple[Dict[str, Any], List[tuple[str, float]]]:
+                """
+                Анализирует один ответ отдельным вызовом (запасной путь для пакетного анализа).
+                Успешно разобранный результат сохраняется в кэш анализа.
+                """
+                item = st.session_state.raw_responses[by_hash[answer_hash][0]]
+                query = item['query']
+                answer_text = get_answer(item)
+
+                analysis_prompt = f"{competitor_prefix}ТЕКСТ_ДЛЯ_АНАЛИЗА: '''{condense_answer(answer_text)}'''"
+
+                # Структурированный анализ упоминаний брендов (LLM-анализ)
+                ranked_entries = await generate_content_with_retry_async(
+                    client,
+                    analysis_prompt,
+                    config=SOV_CONFIG,
+                    decoder=SOV_ENTRIES_DECODER
+                )
+                if ranked_entries is None:
+                    # Ответ не получен или не прошел проверку схемы после всех попыток: строка "Ошибка",
+                    # а не "Не найдено" (результат не кэшируется, повторный запуск проанализирует ответ заново)
+                    st.error(f"Ошибка анализа для запроса: {query}")
+                    return error_result(query)
+
+                result = score_entries(query, ranked_entries)
+                put_cached_analysis((answer_hash, competitors_key), result)
+                return result
+
+            async def analyze_batch(client: genai.Client, batch_hashes: List[bytes]) -> Dict[bytes, Any]:
+                """
+                Анализирует несколько ответов одним вызовом Gemini (пакетная схема с индексами).
+                Ответы, для которых пакетный результат не получен, анализируются по одному.
+                """
+                items = [st.session_state.raw_responses[by_hash[h][0]] for h in batch_hashes]
+                answers = [get_answer(item) for item in items]
+                results: Dict[bytes, Any] = {}
+
+                # Ответы с ошибкой сбора и ответы без упоминаний брендов не отправляются в LLM;
+                # to_analyze — позиции в batch_hashes
+                to_analyze: List[int] = []
+                for pos, (answer_hash, item, answer_text) in enumerate(zip(batch_hashes, items, answers)):
+                    if answer_text == "Ошибка получения ответа API":
+                        results[answer_hash] = error_result(item['query'])
+                    elif not brand_re.search(answer_text):
+                        result = score_entries(item['query'], [])
+                        put_cached_analysis((answer_hash, competitors_key), result)
+                        results[answer_hash] = result
+                    else:
+                        to_analyze.append(pos)
+                if not to_analyze:
+                    return results
+
+                batch_entries: Dict[int, List[SovEntry]] = {}
+                if len(to_analyze) > 1:
+                    documents = [{"index": i, "text": condense_answer(answers[pos])} for i, pos in enumerate(to_analyze)]
+                    batch_prompt = competitor_prefix + "ОТВЕТЫ: " + orjson.dumps(documents).decode()
+
+                    # Ответ читается потоком. Каждая запись начинается с поля "index" (propertyOrdering),
+                    # поэтому число завершенных документов видно до окончания ответа
+                    stream_state = {'tail': "", 'started': 0, 'done': 0}
+
+                    def on_batch_chunk(piece: str):
+                        # Хвост из 6 символов ловит '"index"' (7 символов) на границе фрагментов без двойного счета
+                        text = stream_state['tail'] + piece
+                        stream_state['started'] += text.count('"index"')
+                        stream_state['tail'] = text[-6:]
+                        done = max(0, min(stream_state['started'] - 1, len(documents)))
+                        analysis_progress['done'] += done - stream_state['done']
+                        stream_state['done'] = done
+                        progress_bar.progress(
+                            min(analysis_progress['done'] / analysis_progress['total'], 1.0),
+                            text=f"Пакетный анализ: разобрано ответов {analysis_progress['done']}/{analysis_progress['total']}"
+                        )
+
+                    def on_batch_attempt(attempt: int):
+                        # Повтор присылает пакет заново: ответы, разобранные в прерванной попытке, не учитываются дважды
+                        analysis_progress['done'] -= stream_state['done']
+                        stream_state.update(tail="", started=0, done=0)
+
+                    parsed_batch = await generate_content_with_retry_async(
+                        client,
+                        batch_prompt,
+                        config=SOV_BATCH_CONFIG,
+                        on_chunk=on_batch_chunk,
+                        decoder=SOV_BATCH_DECODER,
+                        on_attempt=on_batch_attempt
+                    )
+                    if parsed_batch is None:
+                        st.warning("Пакетный анализ не выполнен. Ответы будут проанализированы по одному.")
+                    else:
+                        for batch_entry in parsed_batch:
+                            batch_entries[batch_entry.index] = batch_entry.brands
+
+                fallback_hashes = []
+                for i, pos in enumerate(to_analyze):
+                    answer_hash = batch_hashes[pos]
+                    if i in batch_entries:
+                        result = score_entries(items[pos]['query'], batch_entries[i])
+                        put_cached_analysis((answer_hash, competitors_key), result)
+                        results[answer_hash] = result
+                    else:
+                        fallback_hashes.append(answer_hash)
+
+                # Запасной путь: по одному вызову на ответ, параллельно
+                if fallback_hashes:
+                    fallback_results = await gather_bounded([analyze_one(client, h) for h in fallback_hashes])
+                    results.update(zip(fallback_hashes, fallback_results))
+                return results
+
+            # Новые ответы анализируются пакетами вместо N отдельных вызовов. Обычно это один вызов;
+            # при большом объеме ответы делятся на пакеты в пределах лимитов, пакеты идут параллельно.
+            if pending_hashes:
+                batches: List[List[bytes]] = [[]]
+                batch_chars = 0
+                for answer_hash in pending_hashes:
+                    answer_chars = len(get_answer(st.session_state.raw_responses[by_hash[answer_hash][0]]))
+                    if batches[-1] and (
+                        batch_chars + answer_chars > SOV_BATCH_MAX_CHARS
+                        or len(batches[-1]) >= SOV_BATCH_MAX_DOCS
+                    ):
+                        batches.append([])
+                        batch_chars = 0
+                    batches[-1].append(answer_hash)
+                    batch_chars += answer_chars
+
+                progress_bar.progress(
+                    0,
+                    text=f"Анализ {len(pending_hashes)} ответов (пакетных запросов: {len(batches)})..."
+                )
+                batch_outcomes = run_with_client(
+                    lambda client: gather_bounded([analyze_batch(client, b) for b in batches])
+                )
+                for batch_hashes, batch_results in zip(batches, batch_outcomes):
+                    for answer_hash in batch_hashes:
+                        if isinstance(batch_results, BaseException):
+                            unique_results[answer_hash] = batch_results
+                        else:
+                            unique_results[answer_hash] = batch_results.get(
+                                answer_hash, RuntimeError("результат анализа не получен")
+                            )
+
+            # Результат каждого уникального ответа переносится на все запросы с тем же ответом
+            analysis_results: List[Any] = [None] * len(st.session_state.raw_responses)
+            for answer_hash, indices in by_hash.items():
+                result = unique_results[answer_hash]
+                for idx in indices:
+                    if isinstance(result, BaseException):
+                        analysis_results[idx] = result
+                    else:
+                        details, brand_deltas = result
+                        analysis_results[idx] = ({**details, 'Запрос': st.session_state.raw_responses[idx]['query']}, brand_deltas)
+
+            # Однопоточная свертка результатов в общие счетчики (без блокировок)
+            for item, result in zip(st.session_state.raw_responses, analysis_results):
+                if isinstance(result, BaseException):
+                    st.error(f"Ошибка анализа для запроса: {item['query']} ({result})")
+                    result = error_result(item['query'])
+
+                details, brand_deltas = result
+                for brand_name_ranked, final_score in brand_deltas:
+                    score_idx.append(brand_idx[brand_name_ranked])
+                    score_vals.append(final_score)
+
+                # Добавляем детали в отчет (ответ — ссылка на те же сжатые байты, без копии)
+                st.session_state.analysis_details.append({**details, 'answer_z': item['answer_z']})
+
             progress_bar.progress(1.0, text="Анализ завершен!")
             st.success("Анализ Share of Voice завершен!")
 
-            # Формирование финальной таблицы результатов
-            final_data = []
-            for brand_name_original in final_competitors:
-                score = brand_scores.get(brand_name_original, 0.0)
-                
-                # Расчет SoV
-                sov = 0.0
-                if total_tracked_score > 0:
-                    sov = (score / total_tracked_score) * 100
-                
-                final_data.append({
-                    "Бренд": brand_name_original.strip(),
-                    "Итоговый Счет (Total Weighted Score)": round(score, 2),
-                    "AI Share of Voice (%)": round(sov, 2)
-                })
-            
-            st.session_state.results = pd.DataFrame(final_data).sort_values(
+            # Суммирование баллов по брендам одним векторным вызовом (np.add.at корректно учитывает повторы индексов)
+            scores = np.zeros(len(final_competitors), dtype=np.float64)
+            np.add.at(scores, np.asarray(score_idx, dtype=np.intp), np.asarray(score_vals, dtype=np.float64))
+            total_tracked_score = scores.sum() # Общий взвешенный счет всех упоминаний
+            # Расчет SoV
+            sov = scores / total_tracked_score * 100.0 if total_tracked_score > 0 else np.zeros_like(scores)
+
+            st.session_state.results = pd.DataFrame({
+                "Бренд": final_competitors,
+                "Итоговый Счет (Total Weighted Score)": scores.round(2),
+                "AI Share of Voice (%)": sov.round(2)
+            }).sort_values(
                 by=["Итоговый Счет (Total Weighted Score)", "AI Share of Voice (%)"], 
                 ascending=False
             ).reset_index(drop=True)
@@ -551,15 +1409,7 @@ if st.session_state.step == 6 and st.session_state.results is not None:
     """)
     st.caption("Итоговый Счет = Базовый Счет $\times$ Множитель. LLM анализирует **все** упомянутые бренды, присваивая базовый счет 1.0 всем позициям, начиная с 3-й.")
     
-    for detail in st.session_state.analysis_details:
-        with st.expander(f"Запрос: {detail['Запрос'][:60]}... (Счет: {detail['Общий Счет Запроса']})"):
-            st.markdown(f"**Запрос:** `{detail['Запрос']}`")
-            st.markdown(f"**Общий Счет Запроса:** `{detail['Общий Счет Запроса']}`")
-            st.markdown(f"**Детали Анализа:**")
-            st.code(detail['Анализ (Позиция, Тональность, Счет)'], language='markdown')
-            st.markdown("---")
-            st.markdown("**Полный Ответ Gemini:**")
-            st.code(detail['Ответ Gemini'], language='markdown')
+    render_analysis_details(st.session_state.analysis_details)
 
 
 # --- Общее Состояние Приложения (Пояснения) ---
@@ -587,3 +1437,8 @@ else:
     
 st.sidebar.markdown(f"**Текущий Модель:** `{MODEL_NAME}`")
 st.sidebar.markdown(f"**Текущий Шаг:** Шаг {st.session_state.step}")
+
+# Сброс сессии освобождает сохраненные ответы и результаты; общие кэши ответов не затрагиваются
+if st.sidebar.button("Очистить сессию"):
+    st.session_state.clear()
+    st.rerun()